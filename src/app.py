@@ -1,18 +1,27 @@
+from __future__ import annotations
+
 import asyncio
+import heapq
+import itertools
 import logging
 import os
+import re
 import sys
 from dataclasses import dataclass, field
-from datetime import date, time, datetime, timedelta
-from typing import List, Optional, Any
+from datetime import date, time, datetime, timedelta, tzinfo
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Any
+from urllib.parse import quote, unquote
 
-import caldav
-import telegram
-from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
-from jinja2 import Environment, FileSystemLoader
 from pytz import timezone
-from telegram.constants import ParseMode
+
+# The CalDAV, Telegram and template libraries are slow to import, so they are imported where they are used.
+# This keeps the startup fast if the configuration is invalid.
+if TYPE_CHECKING:
+    import caldav
+    import requests
+    from caldav.lib.url import URL
+    from jinja2 import Template
 
 DEFAULT_LOG_LEVEL = 'INFO'
 log_level = os.environ.get('LOG_LEVEL', DEFAULT_LOG_LEVEL)
@@ -24,6 +33,31 @@ else:
     logging.error(f'Invalid LogLevel: {log_level}')
 
 
+TEMPLATE_PATH = 'template.html'
+# Reminders due within this window are sent together in one message
+REMINDER_BATCH_WINDOW = timedelta(seconds=1)
+VEVENT_PATTERN = re.compile(r'^BEGIN:VEVENT\b.*?^END:VEVENT\b', re.IGNORECASE | re.MULTILINE | re.DOTALL)
+RECURRENCE_PATTERN = re.compile(r'^(RRULE|RDATE|EXRULE|EXDATE)[;:]', re.IGNORECASE | re.MULTILINE)
+
+
+def format_date(value, format="%d.%m.%Y %H:%M:%S"):
+    """ Custom filter to format datetime"""
+    if value:
+        return value.strftime(format)
+    return ''
+
+
+def content_value(contents, key):
+    """Return the value of the first vobject content line with the given key or an empty string."""
+    lines = contents.get(key)
+    return lines[0].value if lines else ""
+
+
+def remove_empty_lines(input_string):
+    # Split the string into lines, filter out empty lines, and join the lines back into a string
+    return '\n'.join(line for line in input_string.splitlines() if line.strip())
+
+
 class Config:
     """Configuration class for managing configuration settings."""
 
@@ -35,17 +69,19 @@ class Config:
         self.CALDAV_USERNAME = os.environ.get('CALDAV_USERNAME', None)
         self.CALDAV_PASSWORD = os.environ.get('CALDAV_PASSWORD', None)
         self.CALENDAR_IDS = os.environ.get('CALENDAR_IDS', None)
-        self.SYNC_INTERVAL_IN_SEC = os.environ.get('SYNC_INTERVAL_IN_SEC', 1800)
-        self.FETCH_EVENT_WINDOW_IN_DAYS = os.environ.get('FETCH_EVENT_WINDOW_IN_DAYS', 5)
+        self.SYNC_INTERVAL_IN_SEC = int(os.environ.get('SYNC_INTERVAL_IN_SEC', 1800))
+        self.FETCH_EVENT_WINDOW_IN_DAYS = int(os.environ.get('FETCH_EVENT_WINDOW_IN_DAYS', 5))
         self.TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', None)
         self.TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID', None)
         self.TIMEZONE = timezone(os.environ.get('TIMEZONE', 'UTC'))
         self.DEFAULT_EVENT_REMINDER_MINUTES = os.environ.get('DEFAULT_EVENT_REMINDER_MINUTES', None)
 
         self.CALENDAR_IDS = self.CALENDAR_IDS.split(";") if self.CALENDAR_IDS else None
+        self.DEFAULT_EVENT_REMINDER_MINUTES = int(self.DEFAULT_EVENT_REMINDER_MINUTES) \
+            if self.DEFAULT_EVENT_REMINDER_MINUTES else None
 
 
-@dataclass(order=True)
+@dataclass(slots=True)
 class Reminder:
     """Class representing a reminder."""
     dt: datetime
@@ -54,14 +90,12 @@ class Reminder:
 
     url: str = field(default='')
 
-    @staticmethod
-    def from_vevent(vevent: caldav.vobject, minutes: int, url: str) -> 'Reminder':
-        dtstart: datetime = vevent.dtstart.value
-        alarm_dt = dtstart - timedelta(minutes=minutes)
-        return Reminder(dt=alarm_dt, valarm=None, vevent=vevent, url=url)
+
+# Heap of reminders ordered by their datetime. The counter breaks ties, as reminders are not comparable.
+ReminderHeap = List[Tuple[datetime, int, Reminder]]
 
 
-@dataclass()
+@dataclass(slots=True)
 class Event:
     """Class representing an event."""
     vevent: caldav.vobject
@@ -77,10 +111,26 @@ class CaldavHandler:
         self.principal = None
         self.dav_client = None
         self.config: Config = config
+        # Fetch state per canonical calendar url. Only valid for the search window it was fetched for.
+        self._window_end: Optional[datetime] = None
+        self._etag: Dict[str, str] = {}
+        self._last_modified: Dict[str, str] = {}
+        self.sync_tokens: Dict[str, str] = {}
+        # Calendar urls without collection synchronization, so their sync token is not requested on every sync
+        self._sync_unsupported: Set[str] = set()
+        # Events of the search window per canonical calendar url and event url
+        self._events_by_href: Dict[str, Dict[str, List[Event]]] = {}
+        # Etag and events per canonical calendar url and event url, so unchanged events are not parsed again.
+        # Split by calendar, as the calendars are fetched concurrently.
+        self._parsed: Dict[str, Dict[str, Tuple[str, List[Event]]]] = {}
+        # Timezone of naive datetimes per day, None for days with a DST transition
+        self._day_tzinfos: Dict[date, Optional[tzinfo]] = {}
 
     def login(self, caldav_url: str, username: str, password: str) -> bool:
         """Create CalDAV client and login to the server."""
-        logging.debug(f'Creating caldav client: {caldav_url=}, {username=}')
+        import caldav
+
+        logging.debug('Creating caldav client: caldav_url=%r, username=%r', caldav_url, username)
 
         # Initiating the client object will not cause any server communication,
         # so the credentials aren't validated.
@@ -110,7 +160,7 @@ class CaldavHandler:
         logging.debug('Fetching calendars')
         calendars = self.principal.calendars()
 
-        if logging.getLogger().level == logging.DEBUG:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
             logged_calendar = ''
             for calendar in calendars:
                 logged_calendar += f'\t{calendar.name} ({calendar.id}): {calendar.url}\n'
@@ -119,59 +169,431 @@ class CaldavHandler:
 
         return calendars
 
-    def fetch_events(self, calendars: List[caldav.objects.Calendar]) -> List[Event]:
+    def search_window(self) -> Tuple[datetime, datetime]:
+        """Compute the time range to search events in.
+        The end is rounded up to the next midnight, so the window only moves once a day and
+        cached search results stay valid in between.
+        :return: A tuple of start and end datetime.
+        """
+        start = datetime.now(tz=self.config.TIMEZONE)
+        end_date = start.date() + timedelta(days=self.config.FETCH_EVENT_WINDOW_IN_DAYS + 1)
+        end = self.config.TIMEZONE.localize(datetime.combine(end_date, time(0, 0)))
+        return start, end
+
+    @staticmethod
+    def canonical_url(url: URL) -> str:
+        """Get the canonical form of a url, used as cache key.
+        caldav's URL.canonical() (and so comparing URLs) rewrites the url in place, so a copy is used.
+        :param url: The url.
+        :return: The canonical url as string.
+        """
+        from caldav.lib.url import URL
+
+        return str(URL(str(url)).canonical())
+
+    def object_url(self, calendar: caldav.objects.Calendar, href: str) -> URL:
+        """Resolve an href returned by the server to the url of a calendar object.
+        :param calendar: Calendar object the href belongs to.
+        :param href: The unquoted href from a multistatus response.
+        :return: The absolute url of the object.
+        """
+        from caldav.lib.url import URL
+
+        url = URL(href)
+        if url.hostname is None:
+            url = quote(href)
+        return calendar.url.join(url)
+
+    def events_from_response(self, calendar: caldav.objects.Calendar, cal_key: str,
+                             objects: Iterable[Tuple[str, Dict[str, Optional[str]]]], start: datetime,
+                             end: datetime, filter_range: bool = False) -> Dict[str, List[Event]]:
+        """Create the events of a calendar-query or calendar-multiget response.
+        Events already parsed in the same version (etag) are taken from the cache.
+        :param calendar: Calendar object the response belongs to.
+        :param cal_key: Canonical url of the calendar.
+        :param objects: The href and the properties of each object in the multistatus response.
+        :param start: Start of the search range.
+        :param end: End of the search range.
+        :param filter_range: Drop events outside the search range, for responses without time-range filter.
+        :return: A dict of event urls to the Event objects of their occurrences.
+        """
+        import caldav
+        import recurring_ical_events
+        from caldav.elements import cdav, dav
+
+        events_by_href: Dict[str, List[Event]] = {}
+        parsed = self._parsed.setdefault(cal_key, {})
+        for href, props in objects:
+            url = self.object_url(calendar, href)
+            key = self.canonical_url(url)
+            # Some servers (e.g. iCloud) return the calendar itself as well
+            if key == cal_key:
+                continue
+            etag = props.get(dav.GetEtag.tag)
+            if etag and key in parsed and parsed[key][0] == etag:
+                events_by_href[key] = parsed[key][1]
+                continue
+
+            data = props.pop(cdav.CalendarData.tag, None)
+            dav_event = caldav.objects.Event(self.dav_client, url=url, data=data, parent=calendar, props=props)
+            # Not every server delivers the calendar data with the REPORT response
+            dav_event.load(only_if_unloaded=True)
+            if 'BEGIN:VEVENT' not in dav_event.data:
+                continue
+            if filter_range and not recurring_ical_events.of(dav_event.icalendar_instance).between(start, end):
+                continue
+
+            events = [self.create_event(occurrence) for occurrence in self.expand_events(dav_event, start, end)]
+            events_by_href[key] = events
+            # Replaces the cached events of an older version. Recurring events without occurrences in the window
+            # are not cached, as they could not be told apart from single events when the window moves.
+            if etag and events:
+                parsed[key] = (etag, events)
+            else:
+                parsed.pop(key, None)
+        return events_by_href
+
+    def expand_events(self, dav_event: caldav.objects.Event, start: datetime,
+                      end: datetime) -> List[caldav.objects.Event]:
+        """Expand a recurring event into one event per occurrence in the given range.
+        Single events are detected on the raw calendar data and returned as they are, without parsing them.
+        :param dav_event: The caldav event to expand.
+        :param start: Start of the range.
+        :param end: End of the range.
+        :return: A list of caldav events, one per occurrence.
+        """
+        data = dav_event.data
+        # Only the events are checked, as the STANDARD and DAYLIGHT rules of a VTIMEZONE have RRULEs as well
+        if not any(RECURRENCE_PATTERN.search(data, *vevent.span()) for vevent in VEVENT_PATTERN.finditer(data)):
+            return [dav_event]
+        dav_event.expand_rrule(start, end)
+        return dav_event.split_expanded()
+
+    def search_events(self, calendar: caldav.objects.Calendar, cal_key: str, start: datetime,
+                      end: datetime) -> Optional[Dict[str, List[Event]]]:
+        """Search the events of a calendar in the given range with a conditional REPORT request.
+        :param calendar: Calendar object to search events in.
+        :param cal_key: Canonical url of the calendar.
+        :param start: Start of the search range.
+        :param end: End of the search range.
+        :return: A dict of event urls to Event objects or None if the calendar did not change since the last search.
+        """
+        import caldav
+        from caldav.elements import dav
+        from lxml import etree
+
+        query, _ = calendar.build_search_xml_query(event=True, start=start, end=end, props=[dav.GetEtag()])
+        body = etree.tostring(query.xmlelement(), encoding='utf-8', xml_declaration=True)
+        headers = {'Depth': '1', 'Content-Type': 'application/xml; charset="utf-8"'}
+        url = str(calendar.url)
+        if cal_key in self._etag:
+            headers['If-None-Match'] = self._etag[cal_key]
+        # Fallback for servers without an ETag on calendar collections
+        if cal_key in self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified[cal_key]
+        conditional = 'If-None-Match' in headers or 'If-Modified-Since' in headers
+
+        # The response is parsed while it is received, as it contains the calendar data of all events
+        with self.stream_report(url, body, headers) as response:
+            # Servers answer a matching If-None-Match with 304 or, for methods other than GET/HEAD, with 412.
+            if response.status_code in (304, 412) and conditional:
+                logging.debug('Calendar not modified: %s', url)
+                return None
+            if response.status_code in (401, 403):
+                raise caldav.lib.error.AuthorizationError(url=url, reason=response.reason)
+            if response.status_code >= 400:
+                raise caldav.lib.error.ReportError(url=url, reason=f'{response.status_code} {response.reason}')
+
+            validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            # Let urllib3 undo a gzip or deflate content encoding
+            response.raw.decode_content = True
+            events_by_href = self.events_from_response(calendar, cal_key, self.iter_multistatus(response.raw),
+                                                       start, end)
+
+        # Only remembered once the whole response is processed, as a 304 afterwards relies on the cached events
+        for value, cache in zip(validators, (self._etag, self._last_modified)):
+            if value:
+                cache[cal_key] = value
+            else:
+                cache.pop(cal_key, None)
+        return events_by_href
+
+    def stream_report(self, url: str, body: bytes, headers: Dict[str, str]) -> requests.Response:
+        """Send a REPORT request with the settings of the caldav client, without reading the response body.
+        The client authenticates on login, so its auth is already negotiated.
+        :param url: The url to send the request to.
+        :param body: The XML body of the request.
+        :param headers: Headers in addition to the client's headers.
+        :return: The streamed response. It has to be closed by the caller.
+        """
+        from caldav.lib.url import URL
+
+        client = self.dav_client
+        proxies = {URL(url).scheme: client.proxy} if client.proxy is not None else None
+        return client.session.request('REPORT', url, data=body, headers={**client.headers, **headers},
+                                      proxies=proxies, auth=client.auth, timeout=client.timeout,
+                                      verify=client.ssl_verify_cert, cert=client.ssl_cert, stream=True)
+
+    def iter_multistatus(self, stream) -> Iterator[Tuple[str, Dict[str, Optional[str]]]]:
+        """Parse a multistatus response incrementally, one DAV:response element at a time.
+        Each element is freed once it is processed, so the whole document is never held in memory.
+        :param stream: File-like object of the response body.
+        :return: An iterator of the unquoted href and the found properties of each response.
+        """
+        from caldav.elements import dav
+        from lxml import etree
+
+        # Like caldav's own parsing, the parser limits are lifted only if the client allows huge trees
+        for _, element in etree.iterparse(stream, events=('end',), tag=dav.Response.tag,
+                                          huge_tree=self.dav_client.huge_tree):
+            props: Dict[str, Optional[str]] = {}
+            for propstat in element.iterfind(dav.PropStat.tag):
+                # Properties the server does not have are reported with a 404 status
+                status = propstat.findtext(dav.Status.tag)
+                if status and ' 404 ' in status:
+                    continue
+                for prop in propstat.iterfind(f'{dav.Prop.tag}/*'):
+                    props[prop.tag] = prop.text
+            href = unquote(element.findtext(dav.Href.tag))
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            yield href, props
+
+    def fetch_sync_token(self, calendar: caldav.objects.Calendar) -> Optional[str]:
+        """Fetch the current sync token of a calendar (RFC 6578).
+        :param calendar: Calendar object to fetch the sync token for.
+        :return: The sync token or None if the server does not support collection synchronization.
+        """
+        import caldav
+        from caldav.elements import dav
+
+        try:
+            return calendar.get_property(dav.SyncToken())
+        except caldav.lib.error.DAVError as e:
+            logging.debug('Cannot fetch sync token of %s: %s', calendar.url, e)
+            return None
+
+    def sync_collection(self, calendar: caldav.objects.Calendar, cal_key: str) -> Tuple[List[str], List[str], str]:
+        """Ask the server which objects of a calendar changed since the last sync token (RFC 6578).
+        :param calendar: Calendar object to synchronize.
+        :param cal_key: Canonical url of the calendar.
+        :return: A tuple of the changed and the deleted object urls and the new sync token.
+        """
+        import caldav
+        from caldav.elements import dav
+        from lxml import etree
+
+        url = str(calendar.url)
+        query = dav.SyncCollection() + [dav.SyncToken(value=self.sync_tokens[cal_key]), dav.SyncLevel(value='1'),
+                                        dav.Prop() + dav.GetEtag()]
+        body = etree.tostring(query.xmlelement(), encoding='utf-8', xml_declaration=True)
+        response = self.dav_client.report(url, body, depth=1)
+        # An expired sync token is reported with a DAV:valid-sync-token precondition failure (403 or 409)
+        if response.status >= 400:
+            raise caldav.lib.error.ReportError(caldav.objects.errmsg(response))
+
+        changed: List[str] = []
+        deleted: List[str] = []
+        for item in response.tree.iter(dav.Response.tag):
+            href = self.canonical_url(self.object_url(calendar, unquote(item.findtext(dav.Href.tag))))
+            if href == cal_key:
+                continue
+            status = item.findtext(dav.Status.tag)
+            if status and ' 404 ' in status:
+                deleted.append(href)
+            else:
+                changed.append(href)
+
+        logging.debug('Synchronized %s: %d changed, %d deleted', url, len(changed), len(deleted))
+        return changed, deleted, response.tree.findtext(dav.SyncToken.tag)
+
+    def multiget_events(self, calendar: caldav.objects.Calendar, cal_key: str, urls: List[URL], start: datetime,
+                        end: datetime) -> Dict[str, List[Event]]:
+        """Fetch the given events of a calendar with a single calendar-multiget REPORT request.
+        :param calendar: Calendar object the events belong to.
+        :param cal_key: Canonical url of the calendar.
+        :param urls: List of event urls to fetch.
+        :param start: Start of the search range.
+        :param end: End of the search range.
+        :return: A dict of event urls to Event objects, restricted to the search range.
+        """
+        import caldav
+        from caldav.elements import cdav, dav
+        from lxml import etree
+
+        query = cdav.CalendarMultiGet() + (dav.Prop() + [cdav.CalendarData(), dav.GetEtag()]) + \
+            [dav.Href(value=url.path) for url in urls]
+        body = etree.tostring(query.xmlelement(), encoding='utf-8', xml_declaration=True)
+        response = self.dav_client.report(str(calendar.url), body, depth=1)
+        if response.status >= 400:
+            raise caldav.lib.error.ReportError(caldav.objects.errmsg(response))
+
+        # Unlike the calendar-query, the calendar-multiget has no time-range filter
+        objects = response.expand_simple_props([cdav.CalendarData(), dav.GetEtag()]).items()
+        return self.events_from_response(calendar, cal_key, objects, start, end, filter_range=True)
+
+    def localize(self, dt: datetime) -> datetime:
+        """Localize a naive datetime to the configured timezone.
+        pytz's localize is expensive, so the resulting tzinfo is memoized per day. Days with a DST transition
+        are always localized by pytz.
+        :param dt: The naive datetime.
+        :return: The localized datetime.
+        """
+        day = dt.date()
+        if day not in self._day_tzinfos:
+            first = self.config.TIMEZONE.localize(datetime.combine(day, time.min))
+            last = self.config.TIMEZONE.localize(datetime.combine(day, time.max))
+            self._day_tzinfos[day] = first.tzinfo if first.utcoffset() == last.utcoffset() else None
+
+        tzinfo = self._day_tzinfos[day]
+        if tzinfo is None:
+            return self.config.TIMEZONE.localize(dt)
+        return dt.replace(tzinfo=tzinfo)
+
+    def create_event(self, dav_event: caldav.objects.Event) -> Event:
+        """Create an Event from a caldav event, normalizing its start time and collecting its reminders.
+        :param dav_event: The caldav event to process.
+        :return: The created Event object.
+        """
+        vevent = dav_event.vobject_instance.vevent
+        # Logged with arguments, so they are only formatted if debug logging is enabled
+        logging.debug('Processing event: %s (id: %s, dtstart: %s)', vevent.summary.value, vevent.uid.value,
+                      vevent.dtstart.value)
+
+        dtstart = vevent.dtstart.value
+
+        if type(dtstart) == date:
+            dtstart = datetime.combine(dtstart, time(0, 0))
+            logging.debug('All-Day Event. Start-Time added: %s', dtstart)
+
+        if (dtstart.tzinfo is None or dtstart.tzinfo.utcoffset(dtstart) is None):
+            dtstart = self.localize(dtstart)
+            logging.debug('Timezone added to dtstart: %s', dtstart)
+        else:
+            dtstart = dtstart.astimezone(self.config.TIMEZONE)
+
+        vevent.dtstart.value = dtstart
+        event = Event(vevent=vevent, raw_event=dav_event)
+
+        for valarm in vevent.components():
+            trigger = valarm.trigger.value
+            logging.debug('Found reminder: %s (%s)', trigger, type(trigger))
+            if isinstance(trigger, timedelta):
+                alarm_dt = dtstart + trigger
+            else:
+                alarm_dt = trigger
+            event.reminders.append(
+                Reminder(dt=alarm_dt, valarm=valarm, vevent=vevent, url=dav_event.canonical_url))
+
+        return event
+
+    def evict_parsed(self, cal_key: str, hrefs: Iterable[str]) -> None:
+        """Remove the cached events of the given event urls.
+        :param cal_key: Canonical url of the calendar the events belong to.
+        :param hrefs: Canonical event urls to evict.
+        """
+        parsed = self._parsed.get(cal_key, {})
+        for href in hrefs:
+            parsed.pop(href, None)
+
+    def sync_events(self, calendar: caldav.objects.Calendar, cal_key: str, start: datetime, end: datetime) -> None:
+        """Fetch the events changed since the last sync token and apply them to the cached events of a calendar.
+        The changes are only applied, and the new sync token stored, once the changed events are fetched.
+        Otherwise they are reported again on the next sync.
+        :param calendar: Calendar object to synchronize.
+        :param cal_key: Canonical url of the calendar.
+        :param start: Start of the search range.
+        :param end: End of the search range.
+        """
+        from caldav.lib.url import URL
+
+        changed, deleted, sync_token = self.sync_collection(calendar, cal_key)
+        self.evict_parsed(cal_key, changed + deleted)
+        changed_events = {}
+        if changed:
+            changed_events = self.multiget_events(calendar, cal_key, [URL(href) for href in changed], start, end)
+        events_by_href = self._events_by_href[cal_key]
+        for href in changed + deleted:
+            events_by_href.pop(href, None)
+        events_by_href.update(changed_events)
+        self.sync_tokens[cal_key] = sync_token
+
+    def fetch_calendar_events(self, calendar: caldav.objects.Calendar, start: datetime,
+                              end: datetime) -> List[Event]:
+        """Fetch the events of a calendar in the given range.
+        If the server supports collection synchronization, only changed events are fetched. Otherwise, or
+        if the sync token got invalid, the events are searched in the whole range.
+        :param calendar: Calendar object to fetch events from.
+        :param start: Start of the search range.
+        :param end: End of the search range.
+        :return: A list of Event objects.
+        """
+        import caldav
+
+        # All fetch state is keyed by the canonical url, computed once so the keys always match
+        cal_key = self.canonical_url(calendar.url)
+        if cal_key not in self._events_by_href:
+            # Conditional requests and sync tokens are only valid together with the cached events
+            self._etag.pop(cal_key, None)
+            self._last_modified.pop(cal_key, None)
+            self.sync_tokens.pop(cal_key, None)
+
+        if cal_key in self.sync_tokens:
+            try:
+                self.sync_events(calendar, cal_key, start, end)
+            except (caldav.lib.error.AuthorizationError, caldav.lib.error.ReportError) as e:
+                logging.warning(f'Sync token of {cal_key} rejected, searching for events instead: {e}')
+                del self.sync_tokens[cal_key]
+            else:
+                return [event for events in self._events_by_href[cal_key].values() for event in events]
+
+        # Fetch the sync token before searching, so changes made in between are part of the next sync
+        sync_token = None
+        if cal_key not in self._sync_unsupported:
+            sync_token = self.fetch_sync_token(calendar)
+            if not sync_token:
+                self._sync_unsupported.add(cal_key)
+        logging.debug('Searching for events. Range: [%s, %s]', start, end)
+        events_by_href = self.search_events(calendar, cal_key, start, end)
+        if events_by_href is not None:
+            self.evict_parsed(cal_key, set(self._events_by_href.get(cal_key, {})) - set(events_by_href))
+            self._events_by_href[cal_key] = events_by_href
+        if sync_token:
+            self.sync_tokens[cal_key] = sync_token
+        return [event for events in self._events_by_href.get(cal_key, {}).values() for event in events]
+
+    async def fetch_events(self, calendars: List[caldav.objects.Calendar]) -> List[Event]:
         """Fetch the events from the specified calendars.
         :param calendars: List of Calendar objects to fetch events from.
         :return: A list of Event objects.
         """
-        logging.debug(f'Fetching events for {[cal.id for cal in calendars]}')
-        eventsData: List[Event] = []
-        for item in calendars:
-            calendar = self.dav_client.calendar(url=item.url)
-            start = datetime.now(tz=self.config.TIMEZONE)
-            end = datetime.now(tz=self.config.TIMEZONE) + \
-                  relativedelta(days=int(self.config.FETCH_EVENT_WINDOW_IN_DAYS))
-            logging.debug(f'Searching for events. Range: [{str(start)}, {str(end)}]')
-
-            events = calendar.search(
-                event=True,
-                expand=True,
-                start=start,
-                end=end,
-            )
-
-            for dav_event in events:
-                vevent = dav_event.vobject_instance.vevent
-                logging.debug(
-                    f'Processing event: {vevent.summary.value} (id: {vevent.uid.value}, dtstart: {vevent.dtstart.value})')
-
-                dtstart = vevent.dtstart.value
-
-                if type(dtstart) == date:
-                    dtstart = datetime.combine(dtstart, time(0, 0))
-                    logging.debug(f'All-Day Event. Start-Time added: {dtstart}')
-
-                if (dtstart.tzinfo is None or dtstart.tzinfo.utcoffset(dtstart) is None):
-                    dtstart = self.config.TIMEZONE.localize(dtstart)
-                    logging.debug(f'Timezone added to dtstart: {dtstart}')
-
-                vevent.dtstart.value = dtstart.astimezone(self.config.TIMEZONE)
-                dtstart = vevent.dtstart.value
-                event = Event(vevent=vevent, raw_event=dav_event)
-
-                for valarm in vevent.components():
-                    trigger = valarm.trigger.value
-                    logging.debug(f'Found reminder: {trigger} ({type(trigger)})')
-                    if isinstance(trigger, timedelta):
-                        alarm_dt = dtstart + trigger
-                    else:
-                        alarm_dt = trigger
-                    event.reminders.append(
-                        Reminder(dt=alarm_dt, valarm=valarm, vevent=vevent, url=dav_event.canonical_url))
-
-                eventsData.append(event)
-
-        if logging.getLogger().level == logging.DEBUG:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'Fetching events for {[cal.id for cal in calendars]}')
+        start, end = self.search_window()
+        if end != self._window_end:
+            logging.debug('Search window moved, dropping cached events. Window end: %s', end)
+            self._window_end = end
+            self._etag.clear()
+            self._last_modified.clear()
+            self.sync_tokens.clear()
+            # Checked again once a day, in case the sync token was only missing due to a server error
+            self._sync_unsupported.clear()
+            self._day_tzinfos.clear()
+            # Occurrences of recurring events depend on the window, single events can be reused
+            for url, parsed in self._parsed.items():
+                self._parsed[url] = {key: cached for key, cached in parsed.items()
+                                     if not any('recurrence-id' in event.vevent.contents for event in cached[1])}
+
+        # The caldav client is blocking, so the calendars are fetched concurrently in the default executor
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(None, self.fetch_calendar_events, self.dav_client.calendar(url=item.url), start, end)
+            for item in calendars])
+        eventsData: List[Event] = [event for events in results for event in events]
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
             logged_events = ''
             for event in eventsData:
                 logged_events += \
@@ -180,29 +602,34 @@ class CaldavHandler:
             logging.debug(f'Fetched events({len(eventsData)}):\n{logged_events}')
         return eventsData
 
-    def extract_reminders(self, events: List[Event]) -> List[Reminder]:
+    def extract_reminders(self, events: List[Event]) -> ReminderHeap:
         """Extract reminders from the fetched events.
         :param events: List of Event objects to extract reminders from.
-        :return: A list of Reminder objects.
+        :return: A heap of Reminder objects.
         """
-        logging.debug(f'Extracting Reminders from events: {[event.vevent.uid.value for event in events]}')
-        reminders: List[Reminder] = []
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'Extracting Reminders from events: {[event.vevent.uid.value for event in events]}')
+        reminders: ReminderHeap = []
+        counter = itertools.count()
+        now = datetime.now(tz=self.config.TIMEZONE)
+        default_reminder = timedelta(minutes=self.config.DEFAULT_EVENT_REMINDER_MINUTES) \
+            if self.config.DEFAULT_EVENT_REMINDER_MINUTES is not None else None
         for event in events:
-            if len(event.reminders) == 0 and self.config.DEFAULT_EVENT_REMINDER_MINUTES:
-                logging.debug(f'Adding default reminder for event: {event.vevent.summary.value}')
-                reminder = Reminder.from_vevent(vevent=event.vevent,
-                                                minutes=int(self.config.DEFAULT_EVENT_REMINDER_MINUTES),
-                                                url=event.raw_event.canonical_url)
-                if reminder.dt >= datetime.now(tz=self.config.TIMEZONE):
-                    reminders.append(reminder)
+            if len(event.reminders) == 0 and default_reminder is not None:
+                # Skip past default reminders before creating them
+                alarm_dt = event.vevent.dtstart.value - default_reminder
+                if alarm_dt >= now:
+                    logging.debug('Adding default reminder for event: %s', event.vevent.summary.value)
+                    reminder = Reminder(dt=alarm_dt, valarm=None, vevent=event.vevent, url=event.raw_event.canonical_url)
+                    reminders.append((alarm_dt, next(counter), reminder))
                 continue
             for reminder in event.reminders:
-                if reminder.dt >= datetime.now(tz=self.config.TIMEZONE):
-                    reminders.append(reminder)
-        reminders.sort()
-        if logging.getLogger().level == logging.DEBUG:
+                if reminder.dt >= now:
+                    reminders.append((reminder.dt, next(counter), reminder))
+        heapq.heapify(reminders)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
             logged_events = ''
-            for reminder in reminders:
+            for _, _, reminder in sorted(reminders):
                 logged_events += f'\t{reminder.vevent.summary.value}: {reminder.dt}\n'
 
             logging.debug(f'Extracted reminders:\n{logged_events}')
@@ -214,13 +641,35 @@ class Worker:
 
     def __init__(self, config: Config, calHandler: CaldavHandler):
         """Initialize Worker instance with CaldavHandler."""
-        self.sorted_reminders: List[Reminder] = []
+        import telegram
+        from aiolimiter import AsyncLimiter
+
+        self.reminder_heap: ReminderHeap = []
+        self._reminder_keys: Set[Tuple[str, datetime]] = set()
+        # End of the last dispatched batch. Reminders up to it were already sent, some of them before they were due.
+        self._dispatched_until: Optional[datetime] = None
         self.reminder_task: asyncio.Task = None
         self.calHandler: CaldavHandler = calHandler
         self.config: Config = config
         self.next_sync_dt = datetime.now(tz=self.config.TIMEZONE)
         self.cals: List[caldav.objects.Calendar] = None
         self.event_loop = asyncio.new_event_loop()
+        self.bot = telegram.Bot(token=self.config.TELEGRAM_BOT_TOKEN)
+        # Telegram allows 30 messages per second per bot and 20 messages per minute per group
+        self.bot_limiter = AsyncLimiter(30, 1)
+        self.chat_limiter = AsyncLimiter(20, 60)
+        self.template = self.load_template()
+
+    def load_template(self) -> Optional[Template]:
+        """Load and compile the message template, if the template file exists."""
+        if not os.path.exists(TEMPLATE_PATH):
+            return None
+
+        from jinja2 import Environment, FileSystemLoader
+
+        env = Environment(loader=FileSystemLoader(searchpath='./'))
+        env.filters['format_date'] = format_date
+        return env.get_template(TEMPLATE_PATH)
 
     async def run_at(self, dt, coro):
         """Run the specified coroutine at the specified datetime."""
@@ -233,34 +682,48 @@ class Worker:
 
     def run(self):
         """Run the main event loop for synchronization and reminder processing."""
+        # Initializing the bot verifies the token and opens the connection pool used for all messages
+        self.event_loop.run_until_complete(self.bot.initialize())
         self.event_loop.create_task(self.sync())
-        self.event_loop.run_forever()
+        try:
+            self.event_loop.run_forever()
+        finally:
+            self.event_loop.run_until_complete(self.bot.shutdown())
 
     def scheduleReminderTask(self):
-        """Schedule the next reminder task based on the sorted reminders list."""
+        """Schedule the next reminder task based on the reminder heap."""
         if self.reminder_task:
             self.reminder_task.cancel()
 
-        if len(self.sorted_reminders) > 0:
+        if len(self.reminder_heap) > 0:
             self.reminder_task = self.event_loop.create_task(
-                self.run_at(self.sorted_reminders[0].dt, self.process_reminders))
+                self.run_at(self.reminder_heap[0][0], self.process_reminders))
 
     async def sync(self) -> None:
         """Synchronize calendars and reminders with the server."""
         logging.info('Syncing...')
         try:
+            # The caldav client is blocking, so it runs in the default executor to keep reminders on time
             if self.cals is None:
-                self.cals = self.calHandler.fetch_calendars()
+                self.cals = await self.event_loop.run_in_executor(None, self.calHandler.fetch_calendars)
                 if self.cals is None:
                     logging.error('Cannot sync calendar')
                     return
 
             cals_subscripted = list(filter(lambda x: x.id in self.config.CALENDAR_IDS, self.cals))
-            events = self.calHandler.fetch_events(cals_subscripted)
+            events = await self.calHandler.fetch_events(cals_subscripted)
             if events:
-                sorted_reminders_new = self.calHandler.extract_reminders(events)
-                if sorted_reminders_new != self.sorted_reminders:
-                    self.sorted_reminders = sorted_reminders_new
+                # Always take the new reminders, so changed event details are used in the messages,
+                # but only reschedule if the reminders themselves changed
+                reminder_heap = await self.event_loop.run_in_executor(None, self.calHandler.extract_reminders,
+                                                                      events)
+                if self._dispatched_until is not None:
+                    reminder_heap = [item for item in reminder_heap if item[0] > self._dispatched_until]
+                    heapq.heapify(reminder_heap)
+                self.reminder_heap = reminder_heap
+                reminder_keys = {(reminder.vevent.uid.value, dt) for dt, _, reminder in self.reminder_heap}
+                if reminder_keys != self._reminder_keys:
+                    self._reminder_keys = reminder_keys
                     self.scheduleReminderTask()
 
         except Exception as e:
@@ -268,7 +731,7 @@ class Worker:
             logging.exception(e)
         finally:
             next_sync_dt = datetime.now(tz=self.config.TIMEZONE) + \
-                           relativedelta(seconds=int(self.config.SYNC_INTERVAL_IN_SEC))
+                           timedelta(seconds=self.config.SYNC_INTERVAL_IN_SEC)
 
             loop = asyncio.get_event_loop()
             loop.create_task(self.run_at(next_sync_dt, self.sync))
@@ -278,55 +741,58 @@ class Worker:
         self.reminder_task = None
         try:
             logging.debug('Processing reminders')
-            while await self.process_next_reminder():
-                pass
+            due_reminders: List[Reminder] = []
+            batch_end = datetime.now(tz=self.config.TIMEZONE) + REMINDER_BATCH_WINDOW
+            while len(self.reminder_heap) > 0 and self.reminder_heap[0][0] <= batch_end:
+                due_reminders.append(heapq.heappop(self.reminder_heap)[2])
+            self._dispatched_until = batch_end
+            await self.send_reminders(due_reminders)
             self.scheduleReminderTask()
         except asyncio.CancelledError:
             logging.debug('cancel processing reminders')
             pass
 
-    async def process_next_reminder(self):
-        """Process the next reminder in the sorted reminders list."""
-        if len(self.sorted_reminders) > 0:
-            reminder = self.sorted_reminders.pop(0)
-            if reminder.dt <= datetime.now(tz=self.config.TIMEZONE):
-                logging.info(f'Sending reminder for {reminder.vevent.summary.value}')
-                bot = telegram.Bot(self.config.TELEGRAM_BOT_TOKEN)
-                await bot.send_message(text=self.get_bot_message(reminder),
-                                       chat_id=self.config.TELEGRAM_CHAT_ID, parse_mode=ParseMode.HTML)
-                return True
-        return False
+    async def send_reminders(self, reminders: List[Reminder]):
+        """Send reminder notifications, combining them into as few messages as Telegram's length limit allows."""
+        from telegram.constants import MessageLimit
+
+        messages: List[str] = []
+        for reminder in reminders:
+            logging.info(f'Sending reminder for {reminder.vevent.summary.value}')
+            text = self.get_bot_message(reminder)
+            if messages and len(messages[-1]) + len(text) + 2 <= MessageLimit.MAX_TEXT_LENGTH:
+                messages[-1] += '\n\n' + text
+            else:
+                messages.append(text)
+        await asyncio.gather(*[self.send_message(text) for text in messages])
+
+    async def send_message(self, text: str):
+        """Send a message to the chat, respecting Telegram's rate limits."""
+        import telegram
+        from telegram.constants import ParseMode
+
+        while True:
+            try:
+                async with self.bot_limiter, self.chat_limiter:
+                    await self.bot.send_message(text=text, chat_id=self.config.TELEGRAM_CHAT_ID,
+                                                parse_mode=ParseMode.HTML)
+                return
+            except telegram.error.RetryAfter as e:
+                logging.warning(f'Flood control exceeded, retrying in {e.retry_after}s')
+                await asyncio.sleep(e.retry_after + 0.1)
+            except telegram.error.TelegramError as e:
+                logging.error(f'Cannot send reminder message: {text}')
+                logging.exception(e)
+                return
 
     def get_bot_message(self, reminder: Reminder):
-        # Check if the template file exists
-        template_path = 'template.html'
-
-        def format_date(value, format="%d.%m.%Y %H:%M:%S"):
-            """ Custom filter to format datetime"""
-            if value:
-                return value.strftime(format)
-            return ''
-
-        if os.path.exists(template_path):
-            def remove_empty_lines(input_string):
-                # Split the string into lines, filter out empty lines, and join the lines back into a string
-                return '\n'.join(line for line in input_string.splitlines() if line.strip())
-
-            # Load and render the template using Jinja2
-            env = Environment(loader=FileSystemLoader(searchpath='./'))
-            template = env.get_template('template.html')
-            env.filters['format_date'] = format_date
-
+        if self.template:
             # Render the template with the provided variables
-            msg = template.render(
-                summary=reminder.vevent.contents.get("summary", [None])[
-                    0].value if "summary" in reminder.vevent.contents else "",
-                description=reminder.vevent.contents.get("description", [None])[
-                    0].value if "description" in reminder.vevent.contents else "",
-                location=reminder.vevent.contents.get("location", [None])[
-                    0].value if "location" in reminder.vevent.contents else "",
-                date=reminder.vevent.contents.get("dtstart", [None])[
-                    0].value if "dtstart" in reminder.vevent.contents else "",
+            msg = self.template.render(
+                summary=content_value(reminder.vevent.contents, "summary"),
+                description=content_value(reminder.vevent.contents, "description"),
+                location=content_value(reminder.vevent.contents, "location"),
+                date=content_value(reminder.vevent.contents, "dtstart"),
                 url=reminder.url,
             ).strip()
             return remove_empty_lines(msg)